@@ -0,0 +1,12 @@
+# Copyright (C) 2024  The Software Heritage developers
+# See the AUTHORS file at the top-level directory of this distribution
+# License: GNU General Public License version 3, or any later version
+# See top-level LICENSE file for more information
+
+from hypothesis import settings
+
+# define tests profile. Full documentation is at:
+# https://hypothesis.readthedocs.io/en/latest/settings.html#settings-profiles
+# The property tests run with hypothesis' default settings (100 examples); use
+# --hypothesis-profile=thorough for a more extensive run of them.
+settings.register_profile("thorough", max_examples=500, deadline=None)
@@ -122,9 +122,20 @@ def content_replay(
       https://docs.softwareheritage.org/devel/apidoc/swh.journal.client.html
 
     In addition to these 3 mandatory sections, an optional 'replayer' section
-    can be provided with an 'error_reporter' config entry allowing to specify a
-    Redis connection parameter set that will be used to report objects that
-    could not be copied, eg.::
+    can be provided with:
+
+    - an 'error_reporter' config entry allowing to specify a Redis connection
+      parameter set that will be used to report objects that could not be
+      copied,
+
+    - a 'dst_cache_size' config entry, the number of ids of objects known to be
+      in the destination objstorage kept in memory (100000 by default), so that
+      ``--check-dst`` does not query it again for them. Set it to 0 to disable
+      this cache, eg. if objects may be removed from the destination objstorage
+      while the replayer runs: these would not be copied again while their id
+      is cached.
+
+    eg.::
 
       objstorage:
         [...]
@@ -137,13 +148,18 @@ def content_replay(
           host: redis.local
           port: 6379
           db: 1
+        dst_cache_size: 10000
 
     """
     import mmap
 
     from swh.journal.client import get_journal_client
     from swh.model.model import SHA1_SIZE
-    from swh.objstorage.replayer.replay import ContentReplayer, is_hash_in_bytearray
+    from swh.objstorage.replayer.replay import (
+        DST_CACHE_SIZE,
+        ContentReplayer,
+        SortedHashArray,
+    )
 
     conf = ctx.obj["config"]
     if "objstorage" not in conf:
@@ -156,6 +172,7 @@ def content_replay(
     objstorage_dst_cfg = conf.pop("objstorage_dst")
 
     exclude_fns: List[Callable[[Dict[str, Any]], bool]] = []
+    excluded_sha1s = None
     if exclude_sha1_file:
         map_ = mmap.mmap(exclude_sha1_file.fileno(), 0, prot=mmap.PROT_READ)
         if map_.size() % SHA1_SIZE != 0:
@@ -168,12 +185,8 @@ def content_replay(
             # Tells the kernel not to perform lookahead reads, which we are unlikely
             # to benefit from.
             map_.madvise(mmap.MADV_RANDOM)
-        nb_excluded_hashes = int(map_.size() / SHA1_SIZE)
-
-        def exclude_by_hash(obj):
-            return is_hash_in_bytearray(obj["sha1"], map_, nb_excluded_hashes)
-
-        exclude_fns.append(exclude_by_hash)
+        nb_excluded_hashes = map_.size() // SHA1_SIZE
+        excluded_sha1s = SortedHashArray(map_, nb_excluded_hashes)
 
     if size_limit:
 
@@ -213,9 +226,11 @@ def content_replay(
             src=objstorage_src_cfg,
             dst=objstorage_dst_cfg,
             exclude_fn=exclude_fn,
+            excluded_sha1s=excluded_sha1s,
             check_dst=check_dst,
             check_src_hashes=check_src_hashes,
             concurrency=concurrency,
+            dst_cache_size=replayer_cfg.get("dst_cache_size", DST_CACHE_SIZE),
         ) as replayer:
             if notify:
                 notify("READY=1")
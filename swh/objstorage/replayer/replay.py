@@ -3,10 +3,12 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
+from bisect import bisect_left
+from collections import Counter, OrderedDict
 import logging
-from queue import Empty, Queue
+from queue import Empty, Full, Queue
 import sys
-from threading import Event, Thread
+from threading import Event, Lock, Thread
 from time import time
 from traceback import format_tb
 from typing import Any, Callable, Dict, List, Optional, Tuple
@@ -26,6 +28,11 @@ try:
 except ImportError:
     notify = None
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore[assignment]
+
 from tenacity import (
     RetryCallState,
     retry,
@@ -50,6 +57,9 @@ CONTENT_OPERATIONS_METRIC = "swh_content_replayer_operations_total"
 CONTENT_RETRY_METRIC = "swh_content_replayer_retries_total"
 CONTENT_BYTES_METRIC = "swh_content_replayer_bytes"
 CONTENT_DURATION_METRIC = "swh_content_replayer_duration_seconds"
+CONTENT_DROPPED_REPORTS_METRIC = "swh_content_replayer_dropped_reports_total"
+
+REPORTER_QUEUE_SIZE = 10000
 
 
 class LengthMismatch(Exception):
@@ -110,12 +120,94 @@ def logger_debug_obj_id(msg, args, **kwargs):
         logger.debug(msg, {**args, "obj_id": format_obj_id(args["obj_id"])}, **kwargs)
 
 
+class SortedHashArray:
+    """A read-only, sorted array of fixed-size hashes.
+
+    Wraps a *sorted* concatenation of ``nb_hashes`` hashes (so its size must be
+    ``nb_hashes*hash_size`` bytes), and allows to check whether a given hash is
+    in it. When numpy is available, the search is performed by
+    :func:`numpy.searchsorted` on a view of the array built once at
+    instantiation time; so an instance is meant to be created when loading the
+    array, then queried many times. Otherwise (or if the array does not
+    support the buffer protocol), it falls back to :func:`bisect.bisect_left`,
+    using the instance as a sequence of hashes.
+
+    Args:
+        array (bytes): a sorted concatenated array of hashes (may be of any type
+            supporting slice indexing, eg. :class:`mmap.mmap`; numpy is only
+            used if it also supports the buffer protocol)
+        nb_hashes (int): number of hashes in the array
+        hash_size (int): size of a hash (defaults to 20, for SHA1)
+    """
+
+    def __init__(self, array, nb_hashes, hash_size=SHA1_SIZE):
+        self.array = array
+        self.nb_hashes = nb_hashes
+        self.hash_size = hash_size
+        self._view = None
+        if np is not None:
+            try:
+                self._view = np.frombuffer(
+                    array, dtype=np.dtype((np.void, hash_size)), count=nb_hashes
+                )
+            except TypeError:
+                # the array does not support the buffer protocol; search it
+                # with bisect instead
+                pass
+        # bounds of the array, to reject hashes out of its range without a search
+        self._first = self[0]
+        self._last = self[nb_hashes - 1]
+
+    def __len__(self):
+        return self.nb_hashes
+
+    def __getitem__(self, position):
+        return self.array[position * self.hash_size : (position + 1) * self.hash_size]
+
+    def __contains__(self, hash_):
+        if len(hash_) != self.hash_size:
+            raise ValueError("hash_ does not match the provided hash_size.")
+
+        if not self.nb_hashes or hash_ < self._first or hash_ > self._last:
+            return False
+        if self.nb_hashes == 1:
+            return hash_ == self._first
+
+        if self._view is not None:
+            position = int(np.searchsorted(self._view, np.void(hash_)))
+        else:
+            position = bisect_left(self, hash_)
+        hash_size = self.hash_size
+        start = position * hash_size
+        return (
+            position < self.nb_hashes and self.array[start : start + hash_size] == hash_
+        )
+
+    def contains_many(self, hashes: List[bytes]) -> List[bool]:
+        """Check whether each of the given hashes is in the array.
+
+        When numpy is available, all the hashes are searched at once.
+        """
+        if any(len(hash_) != self.hash_size for hash_ in hashes):
+            raise ValueError("hashes do not match the provided hash_size.")
+        if self._view is None or not self.nb_hashes or not hashes:
+            return [hash_ in self for hash_ in hashes]
+
+        needles = np.frombuffer(b"".join(hashes), dtype=self._view.dtype)
+        positions = np.searchsorted(self._view, needles)
+        np.minimum(positions, self.nb_hashes - 1, out=positions)
+        return (self._view[positions] == needles).tolist()
+
+
 def is_hash_in_bytearray(hash_, array, nb_hashes, hash_size=SHA1_SIZE):
     """
     Checks if the given hash is in the provided `array`. The array must be
     a *sorted* list of sha1 hashes, and contain `nb_hashes` hashes
     (so its size must by `nb_hashes*hash_size` bytes).
 
+    Use :class:`SortedHashArray` directly to look up many hashes in the same
+    array.
+
     Args:
         hash_ (bytes): the hash to look for
         array (bytes): a sorted concatenated array of hashes (may be of
@@ -137,25 +229,7 @@ def is_hash_in_bytearray(hash_, array, nb_hashes, hash_size=SHA1_SIZE):
     >>> is_hash_in_bytearray(hash3, array, 2)
     False
     """
-    if len(hash_) != hash_size:
-        raise ValueError("hash_ does not match the provided hash_size.")
-
-    def get_hash(position):
-        return array[position * hash_size : (position + 1) * hash_size]
-
-    # Regular dichotomy:
-    left = 0
-    right = nb_hashes
-    while left < right - 1:
-        middle = int((right + left) / 2)
-        pivot = get_hash(middle)
-        if pivot == hash_:
-            return True
-        elif pivot < hash_:
-            left = middle
-        else:
-            right = middle
-    return get_hash(left) == hash_
+    return hash_ in SortedHashArray(array, nb_hashes, hash_size)
 
 
 class ReplayError(Exception):
@@ -187,7 +261,7 @@ def log_replay_retry(
         {
             "operation": operation,
             "obj_id": exc.obj_id,
-            "exc": str(exc.exc),
+            "exc": exc.exc,
         },
     )
 
@@ -215,9 +289,46 @@ def log_replay_error(
 
     # if we have a global error (redis) reporter
     if REPORTER is not None:
-        oid = f"blob:{format_obj_id(obj_id)}"
-        msg = msgpack.dumps(error_context)
-        REPORTER(oid, msg)
+        report_error(f"blob:{error_context['obj_id']}", error_context)
+
+
+reporter_queue: Queue = Queue(maxsize=REPORTER_QUEUE_SIZE)
+reporter_thread: Optional[Thread] = None
+reporter_thread_lock = Lock()
+
+
+def report_error(oid: str, error_context: Dict[str, Any]) -> None:
+    """Queue an error report, to be sent to the :data:`REPORTER` by a
+    background thread, so replayer threads do not wait for it.
+
+    Reports are dropped (and counted in statsd) if the queue is full."""
+    global reporter_thread
+    with reporter_thread_lock:
+        if reporter_thread is None:
+            reporter_thread = Thread(target=_reporter_worker, daemon=True)
+            reporter_thread.start()
+    try:
+        reporter_queue.put_nowait((oid, error_context))
+    except Full:
+        logger.warning("Error reporter queue is full, dropping report for %s", oid)
+        statsd.increment(CONTENT_DROPPED_REPORTS_METRIC)
+
+
+def flush_error_reports() -> None:
+    """Wait for all the queued error reports to be sent"""
+    reporter_queue.join()
+
+
+def _reporter_worker() -> None:
+    while True:
+        oid, error_context = reporter_queue.get()
+        try:
+            if REPORTER is not None:
+                REPORTER(oid, msgpack.dumps(error_context))
+        except Exception:
+            logger.exception("Failed to report error for %s", oid)
+        finally:
+            reporter_queue.task_done()
 
 
 def retry_error_callback(retry_state: RetryCallState) -> None:
@@ -241,6 +352,8 @@ def retry_error_callback(retry_state: RetryCallState) -> None:
 
 
 CONTENT_REPLAY_RETRIES = 3
+DST_CACHE_SIZE = 100_000
+CONTENT_REPLAY_CHUNK_SIZE = 64
 
 
 class retry_log_if_success(retry_base):
@@ -326,7 +439,6 @@ def copy_object(
         if check_src_hashes:
             check_hashes(obj, obj_id)
         put_object(dst, obj_id, obj)
-        statsd.increment(CONTENT_BYTES_METRIC, len(obj))
         return len(obj)
     return 0
 
@@ -340,16 +452,46 @@ def obj_in_objstorage(obj_id: CompositeObjId, dst: ObjStorageInterface) -> bool:
         raise ReplayError(obj_id=obj_id, exc=exc) from None
 
 
+class ObjIdCache:
+    """A thread-safe set of object ids, holding at most `max_size` of them by
+    evicting the least recently used ones"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.obj_ids: OrderedDict[Tuple[Any, ...], None] = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, obj_id: CompositeObjId) -> bool:
+        key = tuple(obj_id.values())
+        with self.lock:
+            if key in self.obj_ids:
+                self.obj_ids.move_to_end(key)
+                return True
+        return False
+
+    def add(self, obj_id: CompositeObjId) -> None:
+        if self.max_size <= 0:
+            return
+        key = tuple(obj_id.values())
+        with self.lock:
+            self.obj_ids[key] = None
+            self.obj_ids.move_to_end(key)
+            if len(self.obj_ids) > self.max_size:
+                self.obj_ids.popitem(last=False)
+
+
 class ContentReplayer:
     def __init__(
         self,
         src: Dict[str, Any],
         dst: Dict[str, Any],
         exclude_fn: Optional[Callable[[Dict[str, Any]], bool]] = None,
+        excluded_sha1s: Optional[SortedHashArray] = None,
         check_dst: bool = True,
         check_obj: bool = False,
         check_src_hashes: bool = False,
         concurrency: int = 16,
+        dst_cache_size: int = DST_CACHE_SIZE,
     ):
         """Helper class that takes a list of records from Kafka (see
         :py:func:`swh.journal.client.JournalClient.process`) and copies them
@@ -357,6 +499,7 @@ class ContentReplayer:
 
         * `obj['status']` is `'visible'`
         * `exclude_fn(obj)` is `False` (if `exclude_fn` is provided)
+        * `obj['sha1']` is not in `excluded_sha1s` (if `excluded_sha1s` is provided)
         * `CompositeObjId(**obj) not in dst` (if `check_dst` is True)
 
         Args:
@@ -365,6 +508,8 @@ class ContentReplayer:
             dst: An object storage configuration dict (see
                 :py:func:`swh.objstorage.get_objstorage`)
             exclude_fn: Determines whether an object should be copied.
+            excluded_sha1s: Sorted array of the sha1 of objects not to copy; all
+                the objects of a batch are looked up in it at once.
             check_dst: Determines whether we should check the destination
                 objstorage before copying.
             check_obj: If check_dst is true, determines whether we should check
@@ -373,16 +518,23 @@ class ContentReplayer:
             check_src_hashes: Checks the object before sending it to the dst objstorage.
             concurrency: Number of worker threads doing the replication process
                 (retrieve, check, store).
+            dst_cache_size: Number of ids of objects known to be in the `dst`
+                objstorage to keep in memory, so that `check_dst` does not query
+                the `dst` objstorage again for them (0 to disable). Objects
+                removed from `dst` while their id is cached are not copied
+                again until it is evicted from the cache.
 
         See swh/objstorage/replayer/tests/test_replay.py for usage examples.
         """
         self.src_cfg = src
         self.dst_cfg = dst
         self.exclude_fn = exclude_fn
+        self.excluded_sha1s = excluded_sha1s
         self.check_dst = check_dst
         self.check_obj = check_obj
         self.check_src_hashes = check_src_hashes
         self.concurrency = concurrency
+        self.dst_cache = ObjIdCache(dst_cache_size)
         self.obj_queue: Queue = Queue()
         self.return_queue: Queue = Queue()
         self.stop_event = Event()
@@ -397,13 +549,38 @@ class ContentReplayer:
         self.stop()
 
     def stop(self):
-        """Stop replayer's worker threads"""
+        """Stop replayer's worker threads, and wait for their error reports to
+        be sent"""
         self.stop_event.set()
         for worker in self.workers:
             worker.join()
+        flush_error_reports()
+
+    def _filter_object(
+        self, obj: Dict[str, Any], excluded: bool = False
+    ) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Check whether an object must not be copied, because of its status or
+        because it is excluded; if so, return the decision and statsd tags for
+        this object"""
+        if obj["status"] != "visible":
+            logger_debug_obj_id(
+                "skipped %(obj_id)s (status=%(status)s)",
+                {"obj_id": objid_from_dict(obj), "status": obj["status"]},
+            )
+            return "skipped", {"status": obj["status"], "decision": "skipped"}
+        if excluded or (self.exclude_fn and self.exclude_fn(obj)):
+            logger_debug_obj_id(
+                "skipped %(obj_id)s (manually excluded)",
+                {"obj_id": objid_from_dict(obj)},
+            )
+            return "excluded", {"decision": "excluded"}
+        return None
 
     def _copy_object(
-        self, obj: Dict[str, Any], src: ObjStorageInterface, dst: ObjStorageInterface
+        self,
+        obj: Dict[str, Any],
+        src: ObjStorageInterface,
+        dst: ObjStorageInterface,
     ):
         obj_id = objid_from_dict(obj)
 
@@ -417,19 +594,7 @@ class ContentReplayer:
         copied_bytes = 0
         tags = {}
 
-        if obj["status"] != "visible":
-            logger_debug_obj_id(
-                "skipped %(obj_id)s (status=%(status)s)",
-                {"obj_id": obj_id, "status": obj["status"]},
-            )
-            decision = "skipped"
-            tags["status"] = obj["status"]
-        elif self.exclude_fn and self.exclude_fn(obj):
-            logger_debug_obj_id(
-                "skipped %(obj_id)s (manually excluded)", {"obj_id": obj_id}
-            )
-            decision = "excluded"
-        elif self.check_dst and obj_in_objstorage(obj_id, dst):
+        if self.check_dst and self._in_dst(obj_id, dst):
             decision = "in_dst"
             if self.check_obj:
                 try:
@@ -473,24 +638,49 @@ class ContentReplayer:
                         {"obj_id": obj_id, "bytes": copied_bytes},
                     )
                     decision = "copied"
+                    if self.check_dst:
+                        self.dst_cache.add(obj_id)
         tags["decision"] = decision
-        statsd.increment(CONTENT_OPERATIONS_METRIC, tags=tags)
-        return decision, copied_bytes
+        return decision, copied_bytes, tags
+
+    def _in_dst(self, obj_id: CompositeObjId, dst: ObjStorageInterface) -> bool:
+        """Check if an object is in the dst objstorage, querying it only if the
+        object is not known to be there already"""
+        if obj_id in self.dst_cache:
+            return True
+        if obj_in_objstorage(obj_id, dst):
+            self.dst_cache.add(obj_id)
+            return True
+        return False
 
     def _worker(self):
         src = factory.get_objstorage(**self.src_cfg)
         dst = factory.get_objstorage(**self.dst_cfg)
         while not self.stop_event.is_set():
             try:
-                obj = self.obj_queue.get(timeout=1)
+                chunk = self.obj_queue.get(timeout=1)
             except Empty:
                 continue
-            try:
-                decision, nbytes = self._copy_object(obj, src=src, dst=dst)
-            except Exception as exc:
-                self.return_queue.put(("error", 0, exc))
-            else:
-                self.return_queue.put((decision, nbytes, None))
+            results = []
+            # statsd metrics are aggregated over the chunk, to send a few
+            # packets per chunk instead of one per object
+            operations = Counter()
+            copied_bytes = 0
+            for obj, count in chunk:
+                try:
+                    decision, nbytes, tags = self._copy_object(obj, src=src, dst=dst)
+                except Exception as exc:
+                    results.append(("error", 0, exc, count))
+                else:
+                    results.append((decision, nbytes, None, count))
+                    operations[tuple(sorted(tags.items()))] += count
+                    if decision == "copied":
+                        copied_bytes += nbytes
+            for tags, count in operations.items():
+                statsd.increment(CONTENT_OPERATIONS_METRIC, count, tags=dict(tags))
+            if copied_bytes:
+                statsd.increment(CONTENT_BYTES_METRIC, copied_bytes)
+            self.return_queue.put(results)
 
     def replay(
         self,
@@ -512,35 +702,80 @@ class ContentReplayer:
         )
         t0 = time()
         nobjs = 0
+        # objects delivered several times in the batch are only copied once, but
+        # still accounted for as many times as they were received; they are
+        # identified by all their hashes (objstorages may be keyed on any of
+        # them, and sha1 collisions exist) and the fields their decision
+        # depends on
+        unique_objs: Dict[Tuple[Any, ...], Tuple[Dict[str, Any], bool]] = {}
+        counts: Counter = Counter()
         for object_type, objects in all_objects.items():
             if object_type != "content":
                 logger.warning(
                     "Received a series of %s, this should not happen", object_type
                 )
                 continue
-            for obj in objects:
-                self.obj_queue.put(obj)
-                nobjs += 1
+            if self.excluded_sha1s is not None:
+                excluded = self.excluded_sha1s.contains_many(
+                    [obj["sha1"] for obj in objects]
+                )
+            else:
+                excluded = [False] * len(objects)
+            nobjs += len(objects)
+            for obj, obj_excluded in zip(objects, excluded):
+                key = (
+                    tuple(objid_from_dict(obj).items()),
+                    obj["length"],
+                    obj["status"],
+                )
+                unique_objs.setdefault(key, (obj, obj_excluded))
+                counts[key] += 1
+
+        # objects which are not to be copied are accounted for right away, only
+        # the others are dispatched to the worker threads
+        objs: List[Tuple[Dict[str, Any], int]] = []
+        filtered: Counter = Counter()
+        for key, (obj, obj_excluded) in unique_objs.items():
+            filter_result = self._filter_object(obj, obj_excluded)
+            if filter_result is None:
+                objs.append((obj, counts[key]))
+            else:
+                decision, tags = filter_result
+                stats[decision] += counts[key]
+                filtered[tuple(sorted(tags.items()))] += counts[key]
+        for tags, count in filtered.items():
+            statsd.increment(CONTENT_OPERATIONS_METRIC, count, tags=dict(tags))
+
+        # dispatch objects to the worker threads by chunks, small enough for all
+        # the threads to get some work
+        chunk_size = max(
+            1, min(CONTENT_REPLAY_CHUNK_SIZE, -(-len(objs) // self.concurrency))
+        )
+        for i in range(0, len(objs), chunk_size):
+            self.obj_queue.put(objs[i : i + chunk_size])
 
         logger.debug("Waiting for the obj queue to be processed")
-        results: List[Tuple[str, int, Optional[Exception]]] = []
-        while (not self.stop_event.is_set()) and (len(results) < nobjs):
+        # results are accounted for as they come, but the first error is only
+        # raised once all the chunks are processed, so none is left in the queue
+        first_exc: Optional[Exception] = None
+        nresults = 0
+        while (not self.stop_event.is_set()) and (nresults < len(objs)):
             try:
-                result = self.return_queue.get(timeout=1)
+                chunk_results = self.return_queue.get(timeout=1)
             except Empty:
                 continue
-            else:
-                results.append(result)
+            nresults += len(chunk_results)
+            for decision, nbytes, exc, count in chunk_results:
+                if exc:
+                    first_exc = first_exc or exc
+                else:
+                    if nbytes is not None:
+                        vol += nbytes
+                    stats[decision] += count
 
-        logger.debug("Checking results")
-        for decision, nbytes, exc in results:
-            if exc:
-                # XXX this should not happen, so it is probably wrong...
-                raise exc
-            else:
-                if nbytes is not None:
-                    vol += nbytes
-                stats[decision] += 1
+        if first_exc:
+            # XXX this should not happen, so it is probably wrong...
+            raise first_exc
 
         dt = time() - t0
         logger.info(
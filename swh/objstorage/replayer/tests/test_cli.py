@@ -4,7 +4,7 @@
 # See top-level LICENSE file for more information
 
 from collections import Counter
-import copy
+from contextlib import contextmanager
 import functools
 import logging
 import re
@@ -22,6 +22,7 @@ import yaml
 from swh.journal.serializers import key_to_kafka, value_to_kafka
 from swh.model.hashutil import MultiHash
 from swh.objstorage.backends.in_memory import InMemoryObjStorage
+from swh.objstorage.replayer import replay
 from swh.objstorage.replayer.cli import objstorage_cli_group
 from swh.objstorage.replayer.replay import CONTENT_REPLAY_RETRIES, format_obj_id
 
@@ -64,9 +65,39 @@ def _patch_objstorages(names):
     return decorator
 
 
+def replay_log_records(caplog):
+    """Return the captured log records emitted by the replay module"""
+    return [
+        record
+        for record in caplog.records
+        if record.name == "swh.objstorage.replayer.replay"
+    ]
+
+
+@contextmanager
+def sorted_sha1s_file(sha1s):
+    """Yield the name of a temporary file containing the given sha1s, sorted, as
+    expected by ``--exclude-sha1-file``"""
+    with tempfile.NamedTemporaryFile(mode="w+b") as fd:
+        fd.write(b"".join(sorted(sha1s)))
+        fd.flush()
+        yield fd.name
+
+
+def assert_dst_has(dst, contents, missing=lambda obj_id, content: False):
+    """Check that the (obj_id, content) pairs are in the dst in-memory objstorage,
+    except those for which ``missing(obj_id, content)`` is true, which must not be
+    there"""
+    expected = {
+        dst._state_key(obj_id): None if missing(obj_id, content) else content
+        for obj_id, content in contents
+    }
+    assert {key: dst.state.get(key) for key in expected} == expected
+
+
 def invoke(*args, env=None, **kwargs):
-    config = copy.deepcopy(CLI_CONFIG)
-    config.update(kwargs)
+    # the config is only dumped to the config file, so it can share CLI_CONFIG values
+    config = {**CLI_CONFIG, **kwargs}
 
     runner = CliRunner()
     with tempfile.NamedTemporaryFile("a", suffix=".yml") as config_fd:
@@ -96,28 +127,26 @@ def test_replay_help():
 
 NUM_CONTENTS = 10
 
+# (obj_id, content) pairs of the contents used by the tests, hashed only once
+TEST_CONTENTS = [
+    (
+        MultiHash.from_data(
+            content, hash_names=["sha1", "sha1_git", "sha256", "blake2s256"]
+        ).digest(),
+        content,
+    )
+    for content in (b"\x00" * i + bytes([i]) for i in range(NUM_CONTENTS))
+]
+# and their kafka keys, which do not depend on the test either
+TEST_CONTENT_KEYS = [key_to_kafka(obj_id) for obj_id, _ in TEST_CONTENTS]
+
 
 def _fill_objstorage_and_kafka(
     kafka_server, kafka_prefix, objstorage, mangle_value=None
 ):
-    producer = Producer(
-        {
-            "bootstrap.servers": kafka_server,
-            "client.id": "test-producer",
-            "acks": "all",
-        }
-    )
-
-    contents = []
-    for i in range(NUM_CONTENTS):
-        content = b"\x00" * i + bytes([i])
-        obj_id = (
-            MultiHash(["sha1", "sha1_git", "sha256", "blake2s256"], length=len(content))
-            .from_data(content)
-            .digest()
-        )
-        objstorage.add(content=content, obj_id=obj_id)
-        contents.append((obj_id, content))
+    contents = list(TEST_CONTENTS)
+    messages = []
+    for (obj_id, content), key in zip(contents, TEST_CONTENT_KEYS):
         value = {
             **obj_id,
             "length": len(content),
@@ -125,13 +154,23 @@ def _fill_objstorage_and_kafka(
         }
         if mangle_value:
             value = mangle_value(value)
-        producer.produce(
-            topic=kafka_prefix + ".content",
-            key=key_to_kafka(obj_id),
-            value=value_to_kafka(value),
-        )
+        messages.append((key, value_to_kafka(value)))
+    objstorage.add_batch(contents)
 
-    producer.flush()
+    producer = Producer(
+        {
+            "bootstrap.servers": kafka_server,
+            "client.id": "test-producer",
+            "acks": "all",
+            # send all the messages in a single batch
+            "linger.ms": 50,
+            "batch.num.messages": NUM_CONTENTS,
+        }
+    )
+    for key, value in messages:
+        producer.produce(topic=kafka_prefix + ".content", key=key, value=value)
+
+    assert producer.flush(10) == 0, "Failed to deliver all the test messages"
 
     return contents
 
@@ -165,9 +204,40 @@ def test_replay_content(
     assert result.exit_code == 0, result.output
     assert re.fullmatch(expected, result.output, re.MULTILINE), result.output
 
-    for obj_id, content in contents:
-        assert obj_id in objstorages["dst"], obj_id
-        assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(objstorages["dst"], contents)
+
+
+@_patch_objstorages(["src", "dst"])
+def test_replay_content_dst_cache_size(
+    objstorages,
+    kafka_prefix: str,
+    kafka_consumer_group: str,
+    kafka_server: Tuple[Popen, int],
+    mocker,
+):
+    """Check the size of the dst cache is read from the replayer config"""
+
+    contents = _fill_objstorage_and_kafka(
+        kafka_server, kafka_prefix, objstorages["src"]
+    )
+    obj_id_cache = mocker.spy(replay, "ObjIdCache")
+
+    result = invoke(
+        "replay",
+        "--stop-after-objects",
+        str(NUM_CONTENTS),
+        journal_client={
+            "cls": "kafka",
+            "brokers": kafka_server,
+            "group_id": kafka_consumer_group,
+            "prefix": kafka_prefix,
+        },
+        replayer={"dst_cache_size": 0},
+    )
+
+    assert result.exit_code == 0, result.output
+    obj_id_cache.assert_called_once_with(0)
+    assert_dst_has(objstorages["dst"], contents)
 
 
 @_patch_objstorages(["src", "dst"])
@@ -204,9 +274,8 @@ def test_replay_content_structured_log(
     assert re.fullmatch(expected, result.output, re.MULTILINE), result.output
 
     copied = set()
-    for record in caplog.records:
-        logtext = record.getMessage()
-        if "stored" in logtext:
+    for record in replay_log_records(caplog):
+        if record.msg.startswith("stored"):
             copied.add(record.args["obj_id"])
 
     assert (
@@ -267,9 +336,7 @@ def test_replay_content_static_group_id(
     assert consumer_settings["session.timeout.ms"] == 60 * 10 * 1000
     assert consumer_settings["max.poll.interval.ms"] == 90 * 10 * 1000
 
-    for obj_id, content in contents:
-        assert obj_id in objstorages["dst"], format_obj_id(obj_id)
-        assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(objstorages["dst"], contents)
 
 
 @_patch_objstorages(["src", "dst"])
@@ -290,17 +357,13 @@ def test_replay_content_exclude_by_hash(
 
     # picking half of the contents to exclude
     excluded_contents = [oid["sha1"] for oid, _ in contents[::2]]
-    with tempfile.NamedTemporaryFile(mode="w+b") as fd:
-        fd.write(b"".join(sorted(excluded_contents)))
-
-        fd.seek(0)
-
+    with sorted_sha1s_file(excluded_contents) as exclude_sha1_file:
         result = invoke(
             "replay",
             "--stop-after-objects",
             str(NUM_CONTENTS),
             "--exclude-sha1-file",
-            fd.name,
+            exclude_sha1_file,
             journal_client={
                 "cls": "kafka",
                 "brokers": kafka_server,
@@ -312,12 +375,11 @@ def test_replay_content_exclude_by_hash(
     assert result.exit_code == 0, result.output
     assert re.fullmatch(expected, result.output, re.MULTILINE), result.output
 
-    for obj_id, content in contents:
-        if obj_id["sha1"] in excluded_contents:
-            assert obj_id not in objstorages["dst"], format_obj_id(obj_id)
-        else:
-            assert obj_id in objstorages["dst"], obj_id
-            assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(
+        objstorages["dst"],
+        contents,
+        missing=lambda obj_id, _: obj_id["sha1"] in excluded_contents,
+    )
 
 
 @_patch_objstorages(["src", "dst"])
@@ -366,12 +428,11 @@ def test_replay_content_hash_mismatch(
     assert result.exit_code == 0, result.output
     assert re.fullmatch(expected, result.output, re.MULTILINE), result.output
 
-    for obj_id, content in contents:
-        if obj_id["sha256"] in mangled:
-            assert obj_id not in objstorages["dst"], format_obj_id(obj_id)
-        else:
-            assert obj_id in objstorages["dst"], obj_id
-            assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(
+        objstorages["dst"],
+        contents,
+        missing=lambda obj_id, _: obj_id["sha256"] in mangled,
+    )
 
 
 @_patch_objstorages(["src", "dst"])
@@ -419,12 +480,11 @@ def test_replay_content_length_mismatch(
     assert result.exit_code == 0, result.output
     assert re.fullmatch(expected, result.output, re.MULTILINE), result.output
 
-    for obj_id, content in contents:
-        if obj_id["sha256"] in mangled:
-            assert obj_id not in objstorages["dst"], format_obj_id(obj_id)
-        else:
-            assert obj_id in objstorages["dst"], obj_id
-            assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(
+        objstorages["dst"],
+        contents,
+        missing=lambda obj_id, _: obj_id["sha256"] in mangled,
+    )
 
 
 @_patch_objstorages(["src", "dst"])
@@ -463,12 +523,9 @@ def test_replay_content_exclude_by_size(
     assert any(len(c) > 5 for _, c in contents)
     assert any(len(c) <= 5 for _, c in contents)
 
-    for obj_id, content in contents:
-        if len(content) > 5:
-            assert obj_id not in objstorages["dst"], format_obj_id(obj_id)
-        else:
-            assert obj_id in objstorages["dst"], format_obj_id(obj_id)
-            assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(
+        objstorages["dst"], contents, missing=lambda _, content: len(content) > 5
+    )
 
 
 @_patch_objstorages(["src", "dst"])
@@ -490,11 +547,7 @@ def test_replay_content_exclude_by_both(
     # Exclude half contents by sha1
     excluded_contents = [oid["sha1"] for oid, _ in contents[::2]]
 
-    with tempfile.NamedTemporaryFile(mode="w+b") as fd:
-        fd.write(b"".join(sorted(excluded_contents)))
-
-        fd.seek(0)
-
+    with sorted_sha1s_file(excluded_contents) as exclude_sha1_file:
         result = invoke(
             "replay",
             "--stop-after-objects",
@@ -502,7 +555,7 @@ def test_replay_content_exclude_by_both(
             "--size-limit",
             5,
             "--exclude-sha1-file",
-            fd.name,
+            exclude_sha1_file,
             journal_client={
                 "cls": "kafka",
                 "brokers": kafka_server,
@@ -514,18 +567,27 @@ def test_replay_content_exclude_by_both(
     assert result.exit_code == 0, result.output
     assert re.fullmatch(expected, result.output, re.MULTILINE), result.output
 
-    for obj_id, content in contents:
-        if len(content) > 5:
-            assert obj_id not in objstorages["dst"], format_obj_id(obj_id)
-        elif obj_id["sha1"] in excluded_contents:
-            assert obj_id not in objstorages["dst"], format_obj_id(obj_id)
-        else:
-            assert obj_id in objstorages["dst"], format_obj_id(obj_id)
-            assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(
+        objstorages["dst"],
+        contents,
+        missing=lambda obj_id, content: (
+            len(content) > 5 or obj_id["sha1"] in excluded_contents
+        ),
+    )
 
 
 NUM_CONTENTS_DST = 5
 
+STATS_RE = re.compile(
+    r"processed (?P<tot>\d+) content objects .*"
+    r" *- (?P<copied>\d+) copied"
+    r" *- (?P<in_dst>\d+) in dst"
+    r" *- (?P<skipped>\d+) skipped"
+    r" *- (?P<excluded>\d+) excluded"
+    r" *- (?P<not_found>\d+) not found"
+    r" *- (?P<failed>\d+) failed"
+)
+
 
 @_patch_objstorages(["src", "dst"])
 @pytest.mark.parametrize(
@@ -558,10 +620,10 @@ def test_replay_content_check_dst(
     )
 
     # add some objects in the dst objstorage
-    for obj_id, content in contents[:NUM_CONTENTS_DST]:
-        objstorages["dst"].add(content, obj_id=obj_id)
+    objstorages["dst"].add_batch(contents[:NUM_CONTENTS_DST])
 
-    caplog.set_level(logging.DEBUG, "swh.objstorage.replayer.replay")
+    # the stats are logged at the info level
+    caplog.set_level(logging.INFO, "swh.objstorage.replayer.replay")
 
     result = invoke(
         "replay",
@@ -579,24 +641,13 @@ def test_replay_content_check_dst(
     assert result.exit_code == 0, result.output
     assert re.fullmatch(expected, result.output, re.MULTILINE), result.output
 
-    stats = dict.fromkeys(
-        ["tot", "copied", "in_dst", "skipped", "excluded", "not_found", "failed"], 0
-    )
-    reg = re.compile(
-        r"processed (?P<tot>\d+) content objects .*"
-        r" *- (?P<copied>\d+) copied"
-        r" *- (?P<in_dst>\d+) in dst"
-        r" *- (?P<skipped>\d+) skipped"
-        r" *- (?P<excluded>\d+) excluded"
-        r" *- (?P<not_found>\d+) not found"
-        r" *- (?P<failed>\d+) failed"
-    )
-    for record in caplog.records:
+    # stats are logged for each batch of objects, sum them
+    stats: Counter = Counter()
+    for record in replay_log_records(caplog):
         logtext = record.getMessage()
-        m = reg.match(logtext)
+        m = STATS_RE.match(logtext)
         if m:
-            for k, v in m.groupdict().items():
-                stats[k] += int(v)
+            stats.update({k: int(v) for k, v in m.groupdict().items()})
 
     assert stats["tot"] == sum(v for k, v in stats.items() if k != "tot")
 
@@ -604,9 +655,7 @@ def test_replay_content_check_dst(
         stats["copied"] == expected_copied and stats["in_dst"] == expected_in_dst
     ), "Unexpected amount of objects copied, see the captured log for details"
 
-    for obj_id, content in contents:
-        assert obj_id in objstorages["dst"], format_obj_id(obj_id)
-        assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(objstorages["dst"], contents)
 
 
 class FlakyObjStorage(InMemoryObjStorage):
@@ -626,16 +675,23 @@ class FlakyObjStorage(InMemoryObjStorage):
 
     def __init__(self, *args, **kwargs):
         state = kwargs.pop("state")
-        self.failures_left = Counter(kwargs.pop("failures"))
+        self.failures_left = dict(kwargs.pop("failures"))
         super().__init__(*args, **kwargs)
         if state:
             self.state = state
 
     def flaky_operation(self, op, obj_id):
-        h_obj_id = format_obj_id(obj_id)
-        if self.failures_left[op, h_obj_id] > 0:
-            self.failures_left[op, h_obj_id] -= 1
-            raise RuntimeError("Failed %s on %s" % (op, h_obj_id))
+        if not self.failures_left:
+            # all the configured failures already happened
+            return
+        key = (op, format_obj_id(obj_id))
+        failures_left = self.failures_left.get(key, 0)
+        if failures_left > 0:
+            if failures_left == 1:
+                del self.failures_left[key]
+            else:
+                self.failures_left[key] = failures_left - 1
+            raise RuntimeError("Failed %s on %s" % key)
 
     def get(self, obj_id):
         self.flaky_operation("get", obj_id)
@@ -670,10 +726,9 @@ def test_replay_content_check_dst_retry(
 
     # build a flaky dst objstorage in which the 'in' operation for the first
     # NUM_CONTENT_DST objects will fail once
-    failures = {}
-    for obj_id, content in contents[:NUM_CONTENTS_DST]:
-        objstorages["dst"].add(content, obj_id=obj_id)
-        failures["in", format_obj_id(obj_id)] = 1
+    seeded = contents[:NUM_CONTENTS_DST]
+    objstorages["dst"].add_batch(seeded)
+    failures = {("in", format_obj_id(obj_id)): 1 for obj_id, _ in seeded}
     orig_dst = objstorages["dst"]
     objstorages["dst"] = FlakyObjStorage(state=orig_dst.state, failures=failures)
 
@@ -699,21 +754,19 @@ def test_replay_content_check_dst_retry(
 
     # check that exactly NUM_CONTENTS_DST 'in' operations have failed once
     failed_in = 0
-    for record in caplog.records:
-        logtext = record.getMessage()
-        if "Retry operation obj_in_objstorage" in logtext:
+    for record in replay_log_records(caplog):
+        if record.msg.startswith("Retry operation"):
+            assert (
+                record.args["operation"] == "obj_in_objstorage"
+            ), "No other failure expected than 'in' operations"
             failed_in += 1
-        elif "Retry operation" in logtext:
-            assert False, "No other failure expected than 'in' operations"
     assert failed_in == NUM_CONTENTS_DST
 
     # check nothing has been reported in redis
     assert not redisdb.keys()
 
     # in the end, the replay process should be OK
-    for obj_id, content in contents:
-        assert obj_id in objstorages["dst"], format_obj_id(obj_id)
-        assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(objstorages["dst"], contents)
 
 
 @_patch_objstorages(["src", "dst"])
@@ -779,7 +832,8 @@ def test_replay_content_failed_copy_retry(
         failures=get_failures,
     )
 
-    caplog.set_level(logging.DEBUG, "swh.objstorage.replayer.replay")
+    # only the errors are checked, no need for the debug logs
+    caplog.set_level(logging.INFO, "swh.objstorage.replayer.replay")
 
     result = invoke(
         "replay",
@@ -800,14 +854,10 @@ def test_replay_content_failed_copy_retry(
     assert re.fullmatch(expected, result.output, re.MULTILINE), result.output
 
     # check the logs looks as expected
-    copied = 0
     failed_put = set()
     failed_get = set()
-    for record in caplog.records:
-        logtext = record.getMessage()
-        if "stored" in logtext:
-            copied += 1
-        elif "Failed operation" in logtext:
+    for record in replay_log_records(caplog):
+        if record.msg.startswith("Failed operation"):
             assert record.levelno == logging.ERROR
             assert record.args["retries"] == CONTENT_REPLAY_RETRIES
             assert record.args["operation"] in ("get_object", "put_object")
@@ -834,13 +884,11 @@ def test_replay_content_failed_copy_retry(
 
     # check valid object are in the dst objstorage, but
     # failed objects are not.
-    for obj_id, content in contents:
-        if format_obj_id(obj_id) in definitely_failed:
-            assert obj_id not in objstorages["dst"]
-            continue
-
-        assert obj_id in objstorages["dst"], format_obj_id(obj_id)
-        assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(
+        objstorages["dst"],
+        contents,
+        missing=lambda obj_id, _: format_obj_id(obj_id) in definitely_failed,
+    )
 
 
 @_patch_objstorages(["src", "dst"])
@@ -859,10 +907,13 @@ def test_replay_content_objnotfound(
 
     # delete a few objects from the src objstorage
     num_contents_deleted = 5
-    contents_deleted = set()
-    for obj_id, content in contents[:num_contents_deleted]:
-        del objstorages["src"].state[objstorages["src"]._state_key(obj_id)]
-        contents_deleted.add(format_obj_id(obj_id))
+    src_state = objstorages["src"].state
+    state_key = objstorages["src"]._state_key
+    for obj_id, _ in contents[:num_contents_deleted]:
+        del src_state[state_key(obj_id)]
+    contents_deleted = {
+        format_obj_id(obj_id) for obj_id, _ in contents[:num_contents_deleted]
+    }
 
     caplog.set_level(logging.DEBUG, "swh.objstorage.replayer.replay")
 
@@ -883,15 +934,14 @@ def test_replay_content_objnotfound(
 
     copied = 0
     not_in_src = set()
-    for record in caplog.records:
-        logtext = record.getMessage()
-        if "stored" in logtext:
+    for record in replay_log_records(caplog):
+        if record.msg.startswith("stored"):
             copied += 1
-        elif "object not found" in logtext:
+        elif "object not found" in record.msg:
             # Check that the object id can be recovered from logs
             assert record.levelno == logging.ERROR
             not_in_src.add(record.args["obj_id"])
-        elif "Retry operation" in logtext:
+        elif record.msg.startswith("Retry operation"):
             assert False, "Not found objects should not be retried"
 
     assert (
@@ -902,8 +952,8 @@ def test_replay_content_objnotfound(
         not_in_src == contents_deleted
     ), "Mismatch between deleted contents and not_in_src logs"
 
-    for obj_id, content in contents:
-        if obj_id not in objstorages["src"]:
-            continue
-        assert obj_id in objstorages["dst"], format_obj_id(obj_id)
-        assert objstorages["dst"].get(obj_id) == content
+    assert_dst_has(
+        objstorages["dst"],
+        contents,
+        missing=lambda obj_id, _: format_obj_id(obj_id) in contents_deleted,
+    )
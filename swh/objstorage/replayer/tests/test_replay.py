@@ -3,14 +3,26 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
-from hypothesis import given, settings
+from queue import Queue
+from unittest.mock import patch
+
+from hypothesis import given
 from hypothesis.strategies import sets
+import msgpack
+import pytest
 
 from swh.journal.client import EofBehavior, JournalClient
 from swh.journal.writer import get_journal_writer
 from swh.model.hypothesis_strategies import sha1
 from swh.model.model import Content
-from swh.objstorage.replayer.replay import ContentReplayer, is_hash_in_bytearray
+from swh.objstorage.backends.in_memory import InMemoryObjStorage
+from swh.objstorage.replayer import replay
+from swh.objstorage.replayer.replay import (
+    ContentReplayer,
+    ObjIdCache,
+    SortedHashArray,
+    is_hash_in_bytearray,
+)
 from swh.objstorage.replayer.tests.test_cli import (
     _patch_objstorages as patch_objstorages,
 )
@@ -20,18 +32,55 @@ CONTENTS = [Content.from_data(f"foo{i}".encode()) for i in range(10)] + [
 ]
 
 
-@settings(max_examples=500)
+@pytest.mark.parametrize("np", [replay.np, None], ids=["numpy", "without-numpy"])
 @given(
     sets(sha1(), min_size=0, max_size=500),
     sets(sha1(), min_size=10),
 )
-def test_is_hash_in_bytearray(haystack, needles):
+def test_is_hash_in_bytearray(np, haystack, needles):
     array = b"".join(sorted(haystack))
-    needles |= haystack  # Exhaustively test for all objects in the array
-    for needle in needles:
-        assert is_hash_in_bytearray(needle, array, len(haystack)) == (
-            needle in haystack
-        )
+    needles = list(needles | haystack)  # Exhaustively test for all objects in the array
+    expected = [needle in haystack for needle in needles]
+    with patch.object(replay, "np", np):
+        assert [
+            is_hash_in_bytearray(needle, array, len(haystack)) for needle in needles
+        ] == expected
+
+
+def test_is_hash_in_bytearray_large_array():
+    """A single lookup must not read more than a binary search does, however
+    large the array is"""
+    nb_hashes = 20_000_000
+    reads = []
+
+    class HashArray:
+        """The sorted array of the even 20-byte integers, computed on read"""
+
+        def __getitem__(self, slice_):
+            reads.append(slice_.start)
+            return (2 * (slice_.start // 20)).to_bytes(20, "big")
+
+    # HashArray does not support the buffer protocol, so this also checks
+    # the bisect fallback is used even though numpy is available
+    assert is_hash_in_bytearray((2 * 12345).to_bytes(20, "big"), HashArray(), nb_hashes)
+    assert not is_hash_in_bytearray(
+        (2 * 12345 + 1).to_bytes(20, "big"), HashArray(), nb_hashes
+    )
+    assert len(reads) <= 2 * (nb_hashes.bit_length() + 3)
+
+
+@given(
+    sets(sha1(), min_size=0, max_size=500),
+    sets(sha1(), min_size=10),
+)
+def test_sorted_hash_array_contains_many(haystack, needles):
+    array = b"".join(sorted(haystack))
+    needles = list(needles | haystack)
+    expected = [needle in haystack for needle in needles]
+    assert SortedHashArray(array, len(haystack)).contains_many(needles) == expected
+    with patch.object(replay, "np", None):
+        hashes = SortedHashArray(array, len(haystack))
+        assert hashes.contains_many(needles) == expected
 
 
 @patch_objstorages(["src", "dst"])
@@ -107,3 +156,168 @@ def test_replay_exclude(objstorages):
 
     assert id1 not in dst
     assert id2 in dst
+
+
+@patch_objstorages(["src", "dst"])
+def test_replay_excluded_sha1s(objstorages):
+    src = objstorages["src"]
+    dst = objstorages["dst"]
+    cnt1 = b"foo bar"
+    cnt2 = b"baz qux"
+    id1 = Content.from_data(cnt1).hashes()
+    id2 = Content.from_data(cnt2).hashes()
+    src.add(cnt1, obj_id=id1)
+    src.add(cnt2, obj_id=id2)
+    kafka_partitions = {
+        "content": [
+            {**id1, "length": 7, "status": "visible"},
+            {**id2, "length": 7, "status": "visible"},
+        ]
+    }
+    with ContentReplayer(
+        src={"cls": "mocked", "name": "src"},
+        dst={"cls": "mocked", "name": "dst"},
+        excluded_sha1s=SortedHashArray(id1["sha1"], 1),
+        concurrency=1,
+    ) as replayer:
+        replayer.replay(kafka_partitions)
+
+    assert id1 not in dst
+    assert id2 in dst
+
+
+def test_obj_id_cache():
+    ids = [Content.from_data(f"foo{i}".encode()).hashes() for i in range(3)]
+    cache = ObjIdCache(2)
+    cache.add(ids[0])
+    cache.add(ids[1])
+    assert ids[0] in cache  # ids[1] is now the least recently used
+    cache.add(ids[2])
+    assert ids[0] in cache
+    assert ids[1] not in cache
+    assert ids[2] in cache
+
+    cache = ObjIdCache(0)
+    cache.add(ids[0])
+    assert ids[0] not in cache
+
+
+@patch_objstorages(["src", "dst"])
+def test_replay_dst_cache(objstorages, mocker):
+    src = objstorages["src"]
+    content = Content.from_data(b"foo bar")
+    src.add(content.data, obj_id=content.hashes())
+    kafka_partitions = {
+        "content": [{**content.hashes(), "length": 7, "status": "visible"}]
+    }
+    obj_in_objstorage = mocker.spy(replay, "obj_in_objstorage")
+    with ContentReplayer(
+        src={"cls": "mocked", "name": "src"},
+        dst={"cls": "mocked", "name": "dst"},
+        concurrency=1,
+    ) as replayer:
+        replayer.replay(kafka_partitions)
+        assert obj_in_objstorage.call_count == 1
+        # the object has been copied, so it is known to be in dst
+        replayer.replay(kafka_partitions)
+        assert obj_in_objstorage.call_count == 1
+
+    assert content.hashes() in objstorages["dst"]
+
+
+@patch_objstorages(["src", "dst"])
+def test_replay_dst_cache_without_check_dst(objstorages):
+    src = objstorages["src"]
+    content = Content.from_data(b"foo bar")
+    src.add(content.data, obj_id=content.hashes())
+    kafka_partitions = {
+        "content": [{**content.hashes(), "length": 7, "status": "visible"}]
+    }
+    with ContentReplayer(
+        src={"cls": "mocked", "name": "src"},
+        dst={"cls": "mocked", "name": "dst"},
+        check_dst=False,
+        concurrency=1,
+    ) as replayer:
+        replayer.replay(kafka_partitions)
+        # the cache is only read when checking dst, so it is not filled either
+        assert content.hashes() not in replayer.dst_cache
+
+    assert content.hashes() in objstorages["dst"]
+
+
+@patch_objstorages(["src", "dst"])
+def test_replay_duplicates(objstorages, mocker, caplog):
+    src = objstorages["src"]
+    content = Content.from_data(b"foo bar")
+    src.add(content.data, obj_id=content.hashes())
+    obj = {**content.hashes(), "length": 7, "status": "visible"}
+    copy_object = mocker.spy(replay, "copy_object")
+    with ContentReplayer(
+        src={"cls": "mocked", "name": "src"},
+        dst={"cls": "mocked", "name": "dst"},
+        check_dst=False,
+        dst_cache_size=0,
+    ) as replayer:
+        with caplog.at_level("INFO", logger=replay.__name__):
+            replayer.replay({"content": [obj, dict(obj), dict(obj)]})
+
+    assert copy_object.call_count == 1
+    assert content.hashes() in objstorages["dst"]
+    assert "processed 3 content objects" in caplog.text
+    assert "- 3 copied -" in caplog.text
+
+
+@patch_objstorages(["src", "dst"])
+def test_replay_sha1_collision(objstorages, caplog):
+    # objstorages keyed on sha256 can hold two objects with the same sha1
+    src = objstorages["src"] = InMemoryObjStorage(primary_hash="sha256")
+    dst = objstorages["dst"] = InMemoryObjStorage(primary_hash="sha256")
+    content1 = Content.from_data(b"foo bar")
+    content2 = Content.from_data(b"baz qux")
+    id1 = content1.hashes()
+    id2 = {**content2.hashes(), "sha1": id1["sha1"]}
+    src.add(content1.data, obj_id=id1)
+    src.add(content2.data, obj_id=id2)
+    with ContentReplayer(
+        src={"cls": "mocked", "name": "src"},
+        dst={"cls": "mocked", "name": "dst"},
+    ) as replayer:
+        with caplog.at_level("INFO", logger=replay.__name__):
+            replayer.replay(
+                {
+                    "content": [
+                        {**id1, "length": 7, "status": "visible"},
+                        {**id2, "length": 7, "status": "visible"},
+                    ]
+                }
+            )
+
+    assert dst.get(id1) == content1.data
+    assert dst.get(id2) == content2.data
+    assert "- 2 copied -" in caplog.text
+
+
+def test_report_error(monkeypatch):
+    reports = {}
+    monkeypatch.setattr(replay, "REPORTER", reports.__setitem__)
+    replay.report_error("blob:sha1:0123", {"operation": "get_object", "retries": 3})
+    replay.flush_error_reports()
+    assert {oid: msgpack.loads(msg) for oid, msg in reports.items()} == {
+        "blob:sha1:0123": {"operation": "get_object", "retries": 3}
+    }
+
+
+def test_report_error_queue_full(monkeypatch, mocker, caplog):
+    reporter_queue = Queue(maxsize=1)
+    reporter_queue.put_nowait(("blob:sha1:0123", {}))
+    monkeypatch.setattr(replay, "reporter_queue", reporter_queue)
+    # do not start a reporter thread, which would empty the queue
+    monkeypatch.setattr(replay, "reporter_thread", object())
+    increment = mocker.spy(replay.statsd, "increment")
+
+    replay.report_error("blob:sha1:4567", {"operation": "get_object", "retries": 3})
+
+    increment.assert_called_once_with(replay.CONTENT_DROPPED_REPORTS_METRIC)
+    assert list(reporter_queue.queue) == [("blob:sha1:0123", {})]
+    assert "dropping report for blob:sha1:4567" in caplog.text
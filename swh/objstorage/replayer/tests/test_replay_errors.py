@@ -3,14 +3,16 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
-from collections import defaultdict
-from queue import Queue
-from typing import Tuple, cast
+from collections import Counter
+from typing import Callable, NamedTuple, Optional, Tuple, cast
+
+import pytest
 
 from swh.journal.client import EofBehavior, JournalClient
 from swh.journal.writer import get_journal_writer
 from swh.model.model import Content
 from swh.objstorage import factory
+from swh.objstorage.backends.in_memory import InMemoryObjStorage
 from swh.objstorage.exc import ObjNotFoundError
 from swh.objstorage.interface import CompositeObjId, ObjStorageInterface
 from swh.objstorage.objstorage import ObjStorage
@@ -21,9 +23,12 @@ from swh.objstorage.replayer.tests.test_cli import (
     _patch_objstorages as patch_objstorages,
 )
 
+
 CONTENTS = [Content.from_data(f"foo{i}".encode()) for i in range(10)] + [
     Content.from_data(f"forbidden foo{i}".encode(), status="hidden") for i in range(10)
 ]
+# the contents the replayer is expected to copy
+VISIBLE_CONTENTS = [c for c in CONTENTS if c.status == "visible"]
 
 
 class ObjStorageProxyMixin(ObjStorage):
@@ -47,7 +52,7 @@ class ObjStorageProxyMixin(ObjStorage):
 class FailingObjstorage(ObjStorageProxyMixin):
     def __init__(self, storage):
         super().__init__(storage)
-        self.calls = defaultdict(lambda: 0)
+        self.calls = Counter()
         self.rate = 3
 
     def get(self, obj_id, *args, **kwargs):
@@ -79,26 +84,37 @@ def prepare_test(
         client_id="kafka_writer",
         prefix=kafka_prefix,
         anonymize=False,
+        # send all the contents at once, instead of flushing after each of them
+        auto_flush=False,
+        producer_config={"linger.ms": 50},
     )
 
-    for content in CONTENTS:
-        assert content.data is not None
-        src_objstorage.add(content.data, obj_id=cast(CompositeObjId, content.hashes()))
-        writer.write_addition("content", content)
+    src_objstorage.add_batch(
+        (cast(CompositeObjId, content.hashes()), content.data)
+        for content in CONTENTS
+        if content.data is not None
+    )
+    writer.write_additions("content", CONTENTS)
+    writer.flush()
 
     replayer = JournalClient(
         brokers=kafka_server,
         group_id=kafka_consumer_group,
         prefix=kafka_prefix,
         on_eof=EofBehavior.STOP,
+        # get all the contents in a single batch, without the broker holding
+        # back fetch responses on the (then empty) topic
+        batch_size=len(CONTENTS),
+        consumer_settings={"fetch.wait.max.ms": 10},
     )
 
     return replayer, src_objstorage
 
 
-def copy_object_q(q):
+def copy_object_q(stats_log):
     """Wrap the original copy_object function to capture (thread-local) tenacity
-    stats and puch them in a queue suitable for checking in a test session"""
+    stats and append them to a list suitable for checking in a test session
+    (appending to a list is atomic, so it is safe from the replayer threads)"""
 
     def wrap(obj_id, *args, **kwargs):
         replay.get_object.statistics = {}
@@ -107,176 +123,142 @@ def copy_object_q(q):
             ret = copy_object(obj_id, *args, **kwargs)
             return ret
         finally:
-            q.put(("get", obj_id, replay.get_object.statistics))
-            q.put(("put", obj_id, replay.put_object.statistics))
+            stats_log.append(("get", obj_id, replay.get_object.statistics))
+            stats_log.append(("put", obj_id, replay.put_object.statistics))
 
     return wrap
 
 
-@patch_objstorages(["src", "dst"])
-def test_replay_content_with_transient_errors(
-    objstorages, kafka_server, kafka_prefix, kafka_consumer_group, monkeypatch
-):
-    client, src_objstorage = prepare_test(
-        kafka_server, kafka_prefix, kafka_consumer_group
-    )
-    dst_objstorage = objstorages["dst"]
-    objstorages["src"] = FailingObjstorage(src_objstorage)
-
-    q = Queue()
-    monkeypatch.setattr(replay, "copy_object", copy_object_q(q))
-
-    with replay.ContentReplayer(
-        src={"cls": "mocked", "name": "src"},
-        dst={"cls": "mocked", "name": "dst"},
-    ) as replayer:
-        client.process(replayer.replay)
-
-    # only content with status visible will be copied in storage2
-    expected_objstorage_state = {
-        dst_objstorage._state_key(c.hashes()): c.with_data().data
-        for c in CONTENTS
-        if c.status == "visible"
-    }
-    assert expected_objstorage_state == dst_objstorage.state
-
-    stats = [q.get_nowait() for i in range(q.qsize())]
-    for state_key in expected_objstorage_state:
-        put = next(
-            stat
-            for (meth, oid, stat) in stats
-            if dst_objstorage._state_key(oid) == state_key and meth == "put"
-        )
-        assert put.get("attempt_number") == 1
-        assert put.get("start_time") > 0
-        assert put.get("idle_for") == 0
-
-        get = next(
-            stat
-            for (meth, oid, stat) in stats
-            if dst_objstorage._state_key(oid) == state_key and meth == "get"
-        )
-        assert get.get("attempt_number") == 3
-        assert get.get("start_time") > 0
-        assert get.get("idle_for") > 0
-        assert get.get("delay_since_first_attempt") > 0
+def index_stats(stats):
+    """Index the (method, obj_id, statistics) tuples pushed by copy_object_q by
+    method and sha1 of the object"""
+    return {(meth, oid["sha1"]): stat for (meth, oid, stat) in stats}
+
+
+def check_stats(stats, attempts):
+    """Check the tenacity statistics of an operation expected to have been
+    called ``attempts`` times (0 meaning the operation was not attempted)"""
+    if not attempts:
+        assert stats == {}
+        return
+    assert stats.get("attempt_number") == attempts
+    assert stats.get("start_time") > 0
+    if attempts == 1:
+        assert stats.get("idle_for") == 0
+    else:
+        assert stats.get("idle_for") > 0
+        assert stats.get("delay_since_first_attempt") > 0
+
+
+class ErrorScenario(NamedTuple):
+    side: str
+    """which objstorage misbehaves, ``src`` or ``dst``"""
+    wrapper: Callable[[ObjStorageInterface], ObjStorageInterface]
+    max_attempts: Optional[int]
+    """if set, overrides the maximum number of attempts of each operation"""
+    get_attempts: int
+    put_attempts: int
+    copied: bool
+    """whether the objects are eventually copied"""
+    reported: bool
+    """whether the objects that could not be copied are reported to sentry"""
 
 
 @patch_objstorages(["src", "dst"])
-def test_replay_content_with_errors(
+@pytest.mark.parametrize(
+    "scenario",
+    [
+        pytest.param(
+            ErrorScenario(
+                side="src",
+                wrapper=FailingObjstorage,
+                max_attempts=None,
+                get_attempts=3,
+                put_attempts=1,
+                copied=True,
+                reported=False,
+            ),
+            id="transient-get-errors",
+        ),
+        pytest.param(
+            ErrorScenario(
+                side="src",
+                wrapper=FailingObjstorage,
+                max_attempts=2,
+                get_attempts=2,
+                put_attempts=0,
+                copied=False,
+                reported=True,
+            ),
+            id="get-errors",
+        ),
+        pytest.param(
+            # ObjNotFoundError should not be retried several times
+            ErrorScenario(
+                side="src",
+                wrapper=NotFoundObjstorage,
+                max_attempts=None,
+                get_attempts=1,
+                put_attempts=0,
+                copied=False,
+                reported=False,
+            ),
+            id="not-found",
+        ),
+        pytest.param(
+            ErrorScenario(
+                side="dst",
+                wrapper=FailingObjstorage,
+                max_attempts=None,
+                get_attempts=1,
+                put_attempts=3,
+                copied=True,
+                reported=False,
+            ),
+            id="transient-add-errors",
+        ),
+        pytest.param(
+            ErrorScenario(
+                side="dst",
+                wrapper=FailingObjstorage,
+                max_attempts=2,
+                get_attempts=1,
+                put_attempts=2,
+                copied=False,
+                reported=True,
+            ),
+            id="add-errors",
+        ),
+    ],
+)
+def test_replay_content_errors(
     objstorages,
     kafka_server,
     kafka_prefix,
     kafka_consumer_group,
     monkeypatch,
     mocker,
+    scenario,
 ):
     import sentry_sdk
 
     sentry_sdk.init()
     capture_event = mocker.spy(sentry_sdk.Hub.current.client, "capture_event")
 
-    client, src_objstorage = prepare_test(
-        kafka_server, kafka_prefix, kafka_consumer_group
-    )
-    dst_objstorage = objstorages["dst"]
-    objstorages["src"] = FailingObjstorage(src_objstorage)
-
-    q = Queue()
-    monkeypatch.setattr(replay, "copy_object", copy_object_q(q))
-    monkeypatch.setattr(replay.get_object.retry.stop, "max_attempt_number", 2)
-
-    with replay.ContentReplayer(
-        src={"cls": "mocked", "name": "src"},
-        dst={"cls": "mocked", "name": "dst"},
-    ) as replayer:
-        client.process(replayer.replay)
-
-    # no object could be replicated
-    assert dst_objstorage.state == {}
-    assert capture_event.mock_calls
-
-    stats = [q.get_nowait() for i in range(q.qsize())]
-    for obj in CONTENTS:
-        if obj.status != "visible":
-            continue
-
-        obj_id = obj.hashes()
-        put = next(
-            stat for (meth, oid, stat) in stats if oid == obj_id and meth == "put"
-        )
-        assert put == {}
-
-        get = next(
-            stat for (meth, oid, stat) in stats if oid == obj_id and meth == "get"
-        )
-        assert get.get("attempt_number") == 2
-        assert get.get("start_time") > 0
-        assert get.get("idle_for") > 0
-        assert get.get("delay_since_first_attempt") > 0
-
-        # check hexadecimal hashes are available in sentry event extra data
-        hex_objid = {algo: hash.hex() for algo, hash in obj_id.items()}
-        assert any(
-            mock_call.kwargs["event"]["extra"].get("obj_id") == hex_objid
-            for mock_call in capture_event.mock_calls
-        )
-
-
-@patch_objstorages(["src", "dst"])
-def test_replay_content_not_found(
-    objstorages, kafka_server, kafka_prefix, kafka_consumer_group, monkeypatch
-):
-    client, src_objstorage = prepare_test(
-        kafka_server, kafka_prefix, kafka_consumer_group
-    )
+    # the objstorages of the decorator are shared by all the scenarios, start
+    # each of them from empty ones
+    for name in ("src", "dst"):
+        monkeypatch.setitem(objstorages, name, InMemoryObjStorage())
     dst_objstorage = objstorages["dst"]
-    objstorages["src"] = NotFoundObjstorage(src_objstorage)
-
-    q = Queue()
-    monkeypatch.setattr(replay, "copy_object", copy_object_q(q))
-
-    with replay.ContentReplayer(
-        src={"cls": "mocked", "name": "src"},
-        dst={"cls": "mocked", "name": "dst"},
-    ) as replayer:
-        client.process(replayer.replay)
-
-    # no object could be replicated
-    assert dst_objstorage.state == {}
-
-    stats = [q.get_nowait() for i in range(q.qsize())]
-    for obj in CONTENTS:
-        if obj.status != "visible":
-            continue
-
-        obj_id = obj.hashes()
-        put = next(
-            stat for (meth, oid, stat) in stats if oid == obj_id and meth == "put"
-        )
-        assert put == {}
-
-        get = next(
-            stat for (meth, oid, stat) in stats if oid == obj_id and meth == "get"
+    client, _ = prepare_test(kafka_server, kafka_prefix, kafka_consumer_group)
+    objstorages[scenario.side] = scenario.wrapper(objstorages[scenario.side])
+
+    stats_log = []
+    monkeypatch.setattr(replay, "copy_object", copy_object_q(stats_log))
+    if scenario.max_attempts is not None:
+        monkeypatch.setattr(
+            replay.get_object.retry.stop, "max_attempt_number", scenario.max_attempts
         )
-        # ObjectNotFound should not be retried several times...
-        assert get.get("attempt_number") == 1
-        assert get.get("start_time") > 0
-        assert get.get("idle_for") == 0
-
-
-@patch_objstorages(["src", "dst"])
-def test_replay_content_with_transient_add_errors(
-    objstorages, kafka_server, kafka_prefix, kafka_consumer_group, monkeypatch
-):
-    client, src_objstorage = prepare_test(
-        kafka_server, kafka_prefix, kafka_consumer_group
-    )
-    objstorages["dst"] = FailingObjstorage(objstorages["dst"])
-    dst_objstorage = objstorages["dst"]
-
-    q = Queue()
-    monkeypatch.setattr(replay, "copy_object", copy_object_q(q))
 
     with replay.ContentReplayer(
         src={"cls": "mocked", "name": "src"},
@@ -284,76 +266,24 @@ def test_replay_content_with_transient_add_errors(
     ) as replayer:
         client.process(replayer.replay)
 
-    # only content with status visible will be copied in storage2
-    expected_objstorage_state = {
-        dst_objstorage._state_key(c.hashes()): c.data
-        for c in CONTENTS
-        if c.status == "visible"
-    }
-    assert expected_objstorage_state == dst_objstorage.storage.state
-
-    stats = [q.get_nowait() for i in range(q.qsize())]
-    for state_key in expected_objstorage_state:
-        put = next(
-            stat
-            for (meth, oid, stat) in stats
-            if dst_objstorage._state_key(oid) == state_key and meth == "put"
-        )
-        assert put.get("attempt_number") == 3
-        assert put.get("start_time") > 0
-        assert put.get("idle_for") > 0
-        assert put.get("delay_since_first_attempt") > 0
-
-        get = next(
-            stat
-            for (meth, oid, stat) in stats
-            if dst_objstorage._state_key(oid) == state_key and meth == "get"
-        )
-        assert get.get("attempt_number") == 1
-        assert get.get("start_time") > 0
-        assert get.get("idle_for") == 0
-
-
-@patch_objstorages(["src", "dst"])
-def test_replay_content_with_add_errors(
-    objstorages, kafka_server, kafka_prefix, kafka_consumer_group, monkeypatch
-):
-    client, src_objstorage = prepare_test(
-        kafka_server, kafka_prefix, kafka_consumer_group
+    # only content with status visible can be copied in the dst objstorage
+    expected_objstorage_state = (
+        {dst_objstorage._state_key(c.hashes()): c.data for c in VISIBLE_CONTENTS}
+        if scenario.copied
+        else {}
     )
-    objstorages["dst"] = FailingObjstorage(objstorages["dst"])
-    dst_objstorage = objstorages["dst"]
-
-    q = Queue()
-    monkeypatch.setattr(replay, "copy_object", copy_object_q(q))
-    monkeypatch.setattr(replay.get_object.retry.stop, "max_attempt_number", 2)
-
-    with replay.ContentReplayer(
-        src={"cls": "mocked", "name": "src"},
-        dst={"cls": "mocked", "name": "dst"},
-    ) as replayer:
-        client.process(replayer.replay)
-
-    # no object could be replicated
-    assert dst_objstorage.storage.state == {}
-
-    stats = [q.get_nowait() for i in range(q.qsize())]
-    for obj in CONTENTS:
-        if obj.status != "visible":
-            continue
+    assert expected_objstorage_state == dst_objstorage.state
 
+    stats = index_stats(stats_log)
+    for obj in VISIBLE_CONTENTS:
         obj_id = obj.hashes()
-        put = next(
-            stat for (meth, oid, stat) in stats if oid == obj_id and meth == "put"
-        )
-        assert put.get("attempt_number") == 2
-        assert put.get("start_time") > 0
-        assert put.get("idle_for") > 0
-        assert put.get("delay_since_first_attempt") > 0
-
-        get = next(
-            stat for (meth, oid, stat) in stats if oid == obj_id and meth == "get"
-        )
-        assert get.get("attempt_number") == 1
-        assert get.get("start_time") > 0
-        assert get.get("idle_for") == 0
+        check_stats(stats["get", obj_id["sha1"]], scenario.get_attempts)
+        check_stats(stats["put", obj_id["sha1"]], scenario.put_attempts)
+
+        if scenario.reported:
+            # check hexadecimal hashes are available in sentry event extra data
+            hex_objid = {algo: hash.hex() for algo, hash in obj_id.items()}
+            assert any(
+                mock_call.kwargs["event"]["extra"].get("obj_id") == hex_objid
+                for mock_call in capture_event.mock_calls
+            )
@@ -3,7 +3,9 @@
 # License: GNU General Public License version 3, or any later version
 # See top-level LICENSE file for more information
 
+from collections import defaultdict
 import re
+from typing import Dict, List, Pattern
 
 import pytest
 
@@ -17,6 +19,31 @@ from swh.objstorage.replayer.tests.test_cli import (
 )
 
 
+PREFIX = "swh_content_replayer"
+EXPECTED_REPORTS = {
+    # 4 because 2 for the copied objects + 2 for the in_dst ones
+    f"^{PREFIX}_retries_total:1[|]c[|]#attempt:1,operation:obj_in_objstorage$": 4,
+    f"^{PREFIX}_retries_total:1[|]c[|]#attempt:1,operation:get_object$": 2,
+    f"^{PREFIX}_retries_total:1[|]c[|]#attempt:1,operation:put_object$": 2,
+    f"^{PREFIX}_duration_seconds:[0-9]+[.][0-9]+[|]ms[|]#request:get$": 2,
+    f"^{PREFIX}_duration_seconds:[0-9]+[.][0-9]+[|]ms[|]#request:put$": 2,
+}
+# compiled expected reports, indexed by metric name (what precedes the ':')
+EXPECTED_REPORT_RES: Dict[str, List[Pattern[str]]] = defaultdict(list)
+for pattern in EXPECTED_REPORTS:
+    EXPECTED_REPORT_RES[pattern[1:].split(":", 1)[0]].append(re.compile(pattern))
+# operations and copied bytes are aggregated by the replayer threads, so
+# we sum the values of these counters
+DECISIONS = ("copied", "skipped", "excluded", "in_dst", "not_in_src", "failed")
+OPERATIONS_METRIC = f"{PREFIX}_operations_total"
+BYTES_METRIC = f"{PREFIX}_bytes"
+DECISION_RE = re.compile(
+    f"^{OPERATIONS_METRIC}:(?P<value>[0-9]+)[|]c"
+    "[|]#decision:(?P<decision>" + "|".join(DECISIONS) + ")(?P<extras>,.+)?$"
+)
+BYTES_RE = re.compile(f"^{BYTES_METRIC}:(?P<value>[0-9]+)[|]c$")
+
+
 @pytest.fixture
 def statsd(monkeypatch, statsd):
     monkeypatch.setattr(replay, "statsd", statsd)
@@ -68,6 +95,8 @@ def test_replay_statsd(
         group_id=kafka_consumer_group,
         prefix=kafka_prefix,
         on_eof=EofBehavior.STOP,
+        batch_size=len(contents),
+        consumer_settings={"fetch.wait.max.ms": 10},
     )
 
     with ContentReplayer(
@@ -80,37 +109,30 @@ def test_replay_statsd(
     # We cannot expect any order from replayed objects, so statsd reports won't
     # be sorted according to contents, so we just count the expected occurrence
     # of each statsd message.
-    prefix = "swh_content_replayer"
-    expected_reports = {
-        # 4 because 2 for the copied objects + 2 for the in_dst ones
-        f"^{prefix}_retries_total:1[|]c[|]#attempt:1,operation:obj_in_objstorage$": 4,
-        f"^{prefix}_retries_total:1[|]c[|]#attempt:1,operation:get_object$": 2,
-        f"^{prefix}_retries_total:1[|]c[|]#attempt:1,operation:put_object$": 2,
-        f"^{prefix}_duration_seconds:[0-9]+[.][0-9]+[|]ms[|]#request:get$": 2,
-        f"^{prefix}_duration_seconds:[0-9]+[.][0-9]+[|]ms[|]#request:put$": 2,
-        f"^{prefix}_bytes:4[|]c$": 2,
-    }
-    decisions = ("copied", "skipped", "excluded", "in_dst", "not_in_src", "failed")
-    decision_re = (
-        "^swh_content_replayer_operations_total:1[|]c[|]#decision:(?P<decision>"
-        + "|".join(decisions)
-        + ")(?P<extras>,.+)?$"
-    )
-
-    operations = dict.fromkeys(decisions, 0)
-    reports = dict.fromkeys(expected_reports, 0)
+    operations = dict.fromkeys(DECISIONS, 0)
+    reports = dict.fromkeys(EXPECTED_REPORTS, 0)
+    copied_bytes = 0
 
     for report in (r.decode() for r in statsd.socket.payloads):
-        m = re.match(decision_re, report)
-        if m:
-            operations[m.group("decision")] += 1
-        else:
-            for expected in expected_reports:
-                m = re.match(expected, report)
-                if m:
-                    reports[expected] += 1
-
-    assert reports == expected_reports
+        metric = report.split(":", 1)[0]
+        if metric == OPERATIONS_METRIC:
+            m = DECISION_RE.match(report)
+            if m:
+                operations[m.group("decision")] += int(m.group("value"))
+                continue
+        elif metric == BYTES_METRIC:
+            m = BYTES_RE.match(report)
+            if m:
+                copied_bytes += int(m.group("value"))
+                continue
+        for expected_re in EXPECTED_REPORT_RES.get(metric, ()):
+            if expected_re.match(report):
+                reports[expected_re.pattern] += 1
+                break
+
+    assert reports == EXPECTED_REPORTS
+    # 2 copied objects of 4 bytes
+    assert copied_bytes == 8
 
     assert operations["skipped"] == 2
     assert operations["excluded"] == 2